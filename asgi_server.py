@@ -0,0 +1,166 @@
+# asgi_server.py
+"""ASGI entry point for the node API.
+
+    python asgi_server.py --name node_B --port 5001
+
+Takes the same arguments as server.py and serves the same routes, so
+clients and the React frontend work unchanged. Requests are handled on an
+event loop. The Flask routes run on a bounded pool of threads, and only
+their ZODB access is serialized (by server.storage_lock), so routes that
+never touch storage are not queued behind writes. Outbound replica traffic
+uses async HTTP instead of blocking `requests` calls.
+
+Needs a2wsgi, httpx and uvicorn on top of the packages server.py uses.
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional
+
+import httpx
+import uvicorn
+from a2wsgi import WSGIMiddleware
+from flask import jsonify
+from werkzeug.test import EnvironBuilder
+
+import server  # parses --name/--port/--nodes-file and opens this node's DB
+
+
+# Threads running Flask routes.
+WSGI_WORKERS = 32
+# Threads for blocking work of the async routes: advancing anti-entropy
+# steps (which takes server.storage_lock) and the cluster-state file.
+STORAGE_WORKERS = 4
+REPLICA_TIMEOUT = 5
+
+flask_app = WSGIMiddleware(server.app, workers=WSGI_WORKERS)
+storage_executor = ThreadPoolExecutor(max_workers=STORAGE_WORKERS, thread_name_prefix="zodb")
+http_client: Optional[httpx.AsyncClient] = None
+event_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+async def run_storage(fn, *args):
+    """Run blocking `fn(*args)` on the storage executor."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(storage_executor, fn, *args)
+
+
+async def _drain_body(receive):
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect" or not message.get("more_body", False):
+            return
+
+async def _send_json(send, scope: Dict, payload, status: int = 200):
+    """Send a JSON response built by the Flask app, so its after_request
+    hooks (flask_cors) add the same headers as for any other route."""
+    headers = [(k.decode("latin1"), v.decode("latin1")) for k, v in scope.get("headers", [])]
+    environ = EnvironBuilder(path=scope["path"], method=scope["method"], headers=headers).get_environ()
+    with server.app.request_context(environ):
+        response = server.app.process_response(server.app.make_response((jsonify(payload), status)))
+    await send({
+        "type": "http.response.start",
+        "status": response.status_code,
+        "headers": [(k.lower().encode("latin1"), v.encode("latin1")) for k, v in response.headers.items()],
+    })
+    await send({"type": "http.response.body", "body": response.get_data()})
+
+
+# ---- async replication ----
+
+async def replicate_to(node: str, url: str) -> Optional[Dict]:
+    """Async counterpart of server.replicate_to()."""
+    await run_storage(server.update_replication_status_for, node, "pending")
+    steps = server.anti_entropy_steps()
+    try:
+        done, value = await run_storage(server.advance_steps, steps, None)
+        while not done:
+            method, path, kwargs = value
+            r = await http_client.request(method, f"{url}{path}", **kwargs)
+            r.raise_for_status()
+            done, value = await run_storage(server.advance_steps, steps, r.json())
+    except Exception as e:
+        await run_storage(server.update_replication_status_for, node, "error")
+        server.app.logger.warning(f"Replicate -> error to {node}: {e}")
+        return None
+    repaired, in_sync = value
+    await run_storage(server.update_replication_status_for, node, "synced" if in_sync else "error")
+    return repaired
+
+async def replicate_all(primary: str):
+    # all replicas are repaired concurrently; local steps still serialize on storage_lock
+    await asyncio.gather(*(
+        replicate_to(node, url) for node, url in server.nodes_map.items() if node != primary
+    ))
+
+def schedule_replication():
+    """Replaces server.schedule_replication: run replication on the event loop.
+
+    Called from Flask routes on a worker thread after a write, when
+    server.AUTO_REPLICATE_AFTER_WRITE is on.
+    """
+    primary = server.read_cluster_state().get("primary")
+    asyncio.run_coroutine_threadsafe(replicate_all(primary), event_loop)
+
+async def run_replication(scope: Dict, send):
+    state = await run_storage(server.read_cluster_state)
+    primary = state.get("primary")
+    if server.NODE_NAME != primary:
+        await _send_json(send, scope, {"error": "Only primary can run replication", "primary": primary}, 403)
+        return
+
+    await replicate_all(primary)
+
+    state = await run_storage(server.read_cluster_state)
+    await _send_json(send, scope, state.get("replication_status", {}))
+
+
+# Routes that need outbound replica traffic are served natively; everything
+# else goes to the Flask routes in server.py.
+ASYNC_ROUTES = {
+    ("POST", "/run-replication"): run_replication,
+}
+
+def _close_storage():
+    with server.storage_lock:
+        server.cleanup()
+
+async def lifespan(receive, send):
+    global http_client, event_loop
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            event_loop = asyncio.get_running_loop()
+            server.schedule_replication = schedule_replication
+            http_client = httpx.AsyncClient(
+                timeout=REPLICA_TIMEOUT,
+                limits=httpx.Limits(max_connections=None, max_keepalive_connections=100),
+            )
+            await run_storage(server.read_cluster_state)
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await http_client.aclose()
+            await run_storage(_close_storage)
+            storage_executor.shutdown(wait=True)
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        return
+
+    handler = ASYNC_ROUTES.get((scope["method"], scope["path"]))
+    if handler is not None:
+        await _drain_body(receive)
+        await handler(scope, send)
+        return
+
+    await flask_app(scope, receive, send)
+
+
+if __name__ == "__main__":
+    print(f"Starting node {server.NODE_NAME} (ASGI) on port {server.PORT} -> url {server.nodes_map[server.NODE_NAME]}")
+    print("Cluster state file:", server.CLUSTER_STATE_FILE)
+    uvicorn.run(app, host="0.0.0.0", port=server.PORT, log_level="info")
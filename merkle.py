@@ -0,0 +1,213 @@
+# merkle.py
+import hashlib
+import json
+from typing import Dict, Generator, List, Tuple, Union
+
+import persistent
+from BTrees.OOBTree import OOBTree
+
+
+# Collections of the root that are covered by a digest tree.
+COLLECTIONS = ("people", "deleted_people")
+
+# The tree has 2 ** TREE_DEPTH leaves; each leaf covers one bucket of keys.
+# The depth is fixed so that every node agrees on bucket boundaries; with
+# 65536 buckets a bucket holds about one record up to ~65k records, and
+# N / 65536 records beyond that.
+TREE_DEPTH = 16
+LEAF_COUNT = 2 ** TREE_DEPTH
+EMPTY_DIGEST = bytes(hashlib.sha1().digest_size)
+
+# Levels wider than this must be queried with explicit indexes.
+MAX_LEVEL_NODES = 1024
+
+_KEY_WIDTH = (TREE_DEPTH + 3) // 4
+
+# Hash of an empty subtree at each level; such nodes are not stored.
+_EMPTY_AT = [EMPTY_DIGEST] * (TREE_DEPTH + 1)
+for _level in range(TREE_DEPTH - 1, -1, -1):
+    _EMPTY_AT[_level] = hashlib.sha1(_EMPTY_AT[_level + 1] * 2).digest()
+
+
+class MerkleIndex(persistent.Persistent):
+    """Digest index of one collection.
+
+    `entries` maps "<bucket>/<pid>" -> digest of the record, so the keys of a
+    bucket are one contiguous key range of the OOBTree.  `nodes` maps the
+    heap position (2 ** level + index) of every non-empty tree node to its
+    hash; a leaf is the XOR of the entry digests in its bucket, so a write
+    updates its leaf in O(1) and then the TREE_DEPTH hashes above it.
+    """
+
+    def __init__(self):
+        self.depth = TREE_DEPTH
+        self.entries = OOBTree()
+        self.nodes = OOBTree()
+
+    def node_hash(self, level: int, i: int) -> bytes:
+        return self.nodes.get(2 ** level + i, _EMPTY_AT[level])
+
+    def _set(self, level: int, i: int, h: bytes):
+        if h == _EMPTY_AT[level]:
+            self.nodes.pop(2 ** level + i, None)
+        else:
+            self.nodes[2 ** level + i] = h
+
+    def _rehash(self, level: int, i: int):
+        h = hashlib.sha1(self.node_hash(level + 1, 2 * i) + self.node_hash(level + 1, 2 * i + 1)).digest()
+        self._set(level, i, h)
+
+    def set_leaf(self, bucket: int, h: bytes):
+        """Store a leaf hash and update the path from it to the root."""
+        self._set(TREE_DEPTH, bucket, h)
+        i = bucket
+        for level in range(TREE_DEPTH - 1, -1, -1):
+            i //= 2
+            self._rehash(level, i)
+
+
+def bucket_of(pid: str) -> int:
+    h = hashlib.sha1(str(pid).encode("utf-8")).digest()
+    return int.from_bytes(h[:4], "big") >> (32 - TREE_DEPTH)
+
+def _entry_key(bucket: int, pid: str) -> str:
+    return f"{bucket:0{_KEY_WIDTH}x}/{pid}"
+
+def plain_record(pid: str, value) -> Dict:
+    """Return the replicated fields of a stored person (dict or Person)."""
+    if isinstance(value, dict):
+        return {"id": value.get("id", pid), "name": value.get("name"), "age": int(value.get("age", 0))}
+    return {"id": pid, "name": getattr(value, "name", ""), "age": int(getattr(value, "age", 0))}
+
+def entry_digest(pid: str, value) -> bytes:
+    data = json.dumps(plain_record(pid, value), sort_keys=True, ensure_ascii=False)
+    return hashlib.sha1(data.encode("utf-8")).digest()
+
+def _xor(a: bytes, b: bytes) -> bytes:
+    return bytes(x ^ y for x, y in zip(a, b))
+
+
+def get_index(root, collection: str) -> MerkleIndex:
+    return root["merkle"][collection]
+
+def rebuild(root, collection: str):
+    """Recompute the digest index of `collection` from scratch. Caller commits."""
+    if "merkle" not in root:
+        root["merkle"] = OOBTree()
+    index = MerkleIndex()
+    leaves = {}
+    for pid, value in root.get(collection, {}).items():
+        b = bucket_of(pid)
+        d = entry_digest(pid, value)
+        index.entries[_entry_key(b, pid)] = d
+        leaves[b] = _xor(leaves.get(b, EMPTY_DIGEST), d)
+    for b, h in leaves.items():
+        index._set(TREE_DEPTH, b, h)
+    # fill in only the interior nodes above non-empty leaves
+    touched = set(leaves)
+    for level in range(TREE_DEPTH - 1, -1, -1):
+        touched = {i // 2 for i in touched}
+        for i in touched:
+            index._rehash(level, i)
+    root["merkle"][collection] = index
+
+def index_matches(index: MerkleIndex, store) -> bool:
+    """Check that `index` holds exactly the current digest of every record in `store`."""
+    if getattr(index, "depth", None) != TREE_DEPTH or len(index.entries) != len(store):
+        return False
+    for pid, value in store.items():
+        if index.entries.get(_entry_key(bucket_of(pid), pid)) != entry_digest(pid, value):
+            return False
+    return True
+
+def ensure_indexes(root):
+    """Build, or rebuild, the digest index of every collection that is missing or out of step.
+
+    Verifying reads every record once; it runs at startup so request
+    handlers can treat the index as accurate.
+    """
+    if "merkle" not in root:
+        root["merkle"] = OOBTree()
+    for collection in COLLECTIONS:
+        index = root["merkle"].get(collection)
+        if index is None or not index_matches(index, root.get(collection, {})):
+            rebuild(root, collection)
+
+def touch(root, collection: str, pid: str):
+    """Bring the digest of `pid` in `collection` up to date after a write.
+
+    Must be called after every change of root[collection][pid] (including
+    removal) and before the transaction is committed.
+    """
+    index = get_index(root, collection)
+    b = bucket_of(pid)
+    key = _entry_key(b, pid)
+    old = index.entries.get(key)
+    value = root.get(collection, {}).get(pid)
+    new = None if value is None else entry_digest(pid, value)
+    if old == new:
+        return
+    leaf = index.node_hash(TREE_DEPTH, b)
+    if old is not None:
+        leaf = _xor(leaf, old)
+        del index.entries[key]
+    if new is not None:
+        leaf = _xor(leaf, new)
+        index.entries[key] = new
+    index.set_leaf(b, leaf)
+
+def range_keys(root, collection: str, bucket: int) -> List[str]:
+    """Return the pids of `collection` that fall in leaf `bucket`."""
+    index = get_index(root, collection)
+    lo = f"{bucket:0{_KEY_WIDTH}x}/"
+    hi = f"{bucket:0{_KEY_WIDTH}x}0"  # "0" sorts right after "/"
+    return [k[len(lo):] for k in index.entries.keys(lo, hi, excludemax=True)]
+
+
+def node_hashes(root, collection: str, level: int, indexes: List[int]) -> List[bytes]:
+    """Return the stored hashes of the given nodes of one level (0 is the root)."""
+    index = get_index(root, collection)
+    return [index.node_hash(level, i) for i in indexes]
+
+def root_digest(root, collection: str) -> str:
+    return get_index(root, collection).node_hash(0, 0).hex()
+
+
+def diverging_buckets(index: MerkleIndex) -> Generator[Tuple[int, List[int]], List[str], List[int]]:
+    """Walk the local tree top-down against a remote one.
+
+    Yields (level, indexes) for the remote nodes it needs; the caller sends
+    back their hex hashes in the same order.  Only children of nodes that
+    differ are requested, so the walk costs O(differences * TREE_DEPTH).
+    Returns the leaf buckets whose contents differ.
+    """
+    differing = [0]
+    for depth in range(TREE_DEPTH + 1):
+        if depth > 0:
+            differing = [c for i in differing for c in (2 * i, 2 * i + 1)]
+        remote = yield depth, differing
+        differing = [i for i, h in zip(differing, remote) if index.node_hash(depth, i).hex() != h]
+        if not differing:
+            break
+    return differing
+
+def parse_indexes(raw: Union[str, List[int], None], depth: int) -> List[int]:
+    """Parse node indexes of one level.
+
+    Accepts a query parameter ("1,5,6") or a JSON list ([1, 5, 6]); None
+    selects the whole level.
+    """
+    size = 2 ** depth
+    if raw is None or raw == "":
+        if size > MAX_LEVEL_NODES:
+            raise ValueError(f"index is required for level {depth}")
+        return list(range(size))
+    if isinstance(raw, str):
+        out = [int(x) for x in raw.split(",")]
+    elif isinstance(raw, list) and all(type(i) is int for i in raw):
+        out = raw
+    else:
+        raise ValueError("index must be a list of integers")
+    if any(i < 0 or i >= size for i in out):
+        raise ValueError(f"index out of range for level {depth}")
+    return out
@@ -1,5 +1,6 @@
 # server.py
 import argparse
+import functools
 import json
 import os
 import threading
@@ -13,6 +14,8 @@ from flask_cors import CORS
 import ZODB, ZODB.FileStorage, transaction
 from BTrees.OOBTree import OOBTree
 
+import merkle
+
 
 DATA_DIR = "data"
 os.makedirs(DATA_DIR, exist_ok=True)
@@ -25,22 +28,31 @@ DEFAULT_NODES = {
 }
 
 
+# Serializes read-modify-write of the cluster state file within this process.
+cluster_state_lock = threading.RLock()
+
 def read_cluster_state() -> Dict:
     """Return cluster state: {'primary': 'node_A', 'replication_status': {..}}"""
-    if not os.path.exists(CLUSTER_STATE_FILE):
-        # initialize
-        initial = {
-            "primary": "node_A",
-            "replication_status": {k: "synced" for k in DEFAULT_NODES.keys()}
-        }
-        write_cluster_state(initial)
-        return initial
-    with open(CLUSTER_STATE_FILE, "r", encoding="utf-8") as f:
-        return json.load(f)
+    with cluster_state_lock:
+        if not os.path.exists(CLUSTER_STATE_FILE):
+            # initialize
+            initial = {
+                "primary": "node_A",
+                "replication_status": {k: "synced" for k in DEFAULT_NODES.keys()}
+            }
+            write_cluster_state(initial)
+            return initial
+        with open(CLUSTER_STATE_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
 
 def write_cluster_state(state: Dict):
-    with open(CLUSTER_STATE_FILE, "w", encoding="utf-8") as f:
-        json.dump(state, f, indent=2)
+    # write a temp file and rename it, so readers (other node processes
+    # share this file) never see a half-written state
+    tmp = f"{CLUSTER_STATE_FILE}.{os.getpid()}.tmp"
+    with cluster_state_lock:
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(state, f, indent=2)
+        os.replace(tmp, CLUSTER_STATE_FILE)
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--name", type=str, default="node_A", help="node name (node_A/node_B/node_C)")
@@ -69,12 +81,12 @@ CORS(app)
 def get_fs_path(node_name: str) -> str:
     return os.path.join(DATA_DIR, f"{node_name}.fs")
 
-def open_db(node_name: str):
+def open_db(node_name: str, transaction_manager=None):
     """Open the ZODB DB for given node_name and return (db, conn, root). Caller should close conn/db when done."""
     path = get_fs_path(node_name)
     storage = ZODB.FileStorage.FileStorage(path)
     db = ZODB.DB(storage)
-    conn = db.open()
+    conn = db.open(transaction_manager)
     root = conn.root()
     return db, conn, root
 
@@ -98,7 +110,15 @@ for n in nodes_map.keys():
     init_node_db_if_missing(n)
 
 
-db, conn, root = open_db(NODE_NAME)
+# The node's connection is shared by every request thread. The default
+# transaction manager is per thread, so a commit from any thread but this one
+# would not include the connection's changes; give it a manager of its own
+# and commit through it. Neither the connection nor the manager is
+# thread-safe, so all access to conn/root and every commit must hold
+# storage_lock (see with_storage).
+txn_manager = transaction.TransactionManager()
+storage_lock = threading.RLock()
+db, conn, root = open_db(NODE_NAME, txn_manager)
 
 
 if "people" not in root:
@@ -107,7 +127,25 @@ if "versions" not in root:
     root["versions"] = OOBTree()
 if "redo_stack" not in root:
     root["redo_stack"] = OOBTree()
-transaction.commit()
+# older databases kept deleted_people as a plain dict, whose in-place
+# changes are never saved; move it into a persistent OOBTree
+if not isinstance(root.get("deleted_people"), OOBTree):
+    root["deleted_people"] = OOBTree(root.get("deleted_people", {}))
+merkle.ensure_indexes(root)
+txn_manager.commit()
+
+
+def with_storage(fn):
+    """Run a route while holding storage_lock; abort the transaction if it fails."""
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        with storage_lock:
+            try:
+                return fn(*args, **kwargs)
+            except Exception:
+                txn_manager.abort()
+                raise
+    return wrapper
 
 
 def get_local_people_list():
@@ -147,29 +185,64 @@ def replace_local_people_from_list(list_people: List[Dict]):
     root["people"] = ppl
     root["versions"] = versions
     root["redo_stack"] = redo_stack
-    transaction.commit()
+    merkle.rebuild(root, "people")
+    txn_manager.commit()
+
+def _touch_digests(pid: str):
+    """Update the Merkle digests of `pid` in every tracked collection."""
+    for collection in merkle.COLLECTIONS:
+        merkle.touch(root, collection, pid)
+
+def replace_local_range(collection: str, bucket: int, list_people: List[Dict]):
+    """Replace the records of one Merkle bucket of `collection`, leaving other keys untouched. Caller commits."""
+    _ensure_history_structures()
+    store = root[collection]
+    stale = merkle.range_keys(root, collection, bucket)
+
+    incoming = {}
+    for p in list_people:
+        pid = p.get("id")
+        incoming[pid] = {"id": pid, "name": p.get("name"), "age": int(p.get("age", 0))}
+        if collection == "deleted_people":
+            incoming[pid]["is_deleted"] = True
+
+    for pid in stale:
+        if pid not in incoming:
+            store.pop(pid, None)
+            if collection == "people":
+                root["versions"].pop(pid, None)
+                root["redo_stack"].pop(pid, None)
+    for pid, rec in incoming.items():
+        store[pid] = rec
+        if collection == "people":
+            root["versions"][pid] = [rec.copy()]
+            root["redo_stack"][pid] = []
+
+    for pid in set(stale) | set(incoming):
+        merkle.touch(root, collection, pid)
 
 def is_primary() -> bool:
     state = read_cluster_state()
     return state.get("primary") == NODE_NAME
 
 def update_replication_status_for(node_name: str, status: str):
-    state = read_cluster_state()
-    rs = state.get("replication_status", {})
-    rs[node_name] = status
-    state["replication_status"] = rs
-    write_cluster_state(state)
+    with cluster_state_lock:
+        state = read_cluster_state()
+        rs = state.get("replication_status", {})
+        rs[node_name] = status
+        state["replication_status"] = rs
+        write_cluster_state(state)
 
 def _ensure_history_structures():
     """Đảm bảo tất cả các cấu trúc ZODB tồn tại."""
     if "people" not in root:
-        root["people"] = {}
+        root["people"] = OOBTree()
     if "versions" not in root:
-        root["versions"] = {}
+        root["versions"] = OOBTree()
     if "redo_stack" not in root:
-        root["redo_stack"] = {}
+        root["redo_stack"] = OOBTree()
     if "deleted_people" not in root:
-        root["deleted_people"] = {}
+        root["deleted_people"] = OOBTree()
 
 def push_version(pid: str, snapshot: Optional[Dict]):
 
@@ -178,13 +251,13 @@ def push_version(pid: str, snapshot: Optional[Dict]):
     if pid not in versions:
         versions[pid] = []
     versions[pid].append(None if snapshot is None else snapshot.copy())
-    transaction.commit()
+    txn_manager.commit()
 
 def clear_redo(pid: str):
     _ensure_history_structures()
     redo = root["redo_stack"]
     redo[pid] = []
-    transaction.commit()
+    txn_manager.commit()
 
 def push_redo(pid: str, snapshot: Optional[Dict]):
     _ensure_history_structures()
@@ -192,7 +265,7 @@ def push_redo(pid: str, snapshot: Optional[Dict]):
     if pid not in redo:
         redo[pid] = []
     redo[pid].append(None if snapshot is None else snapshot.copy())
-    transaction.commit()
+    txn_manager.commit()
 
 def pop_redo(pid: str) -> Optional[Dict]:
     _ensure_history_structures()
@@ -200,7 +273,7 @@ def pop_redo(pid: str) -> Optional[Dict]:
     if pid not in redo or len(redo[pid]) == 0:
         return None
     item = redo[pid].pop()
-    transaction.commit()
+    txn_manager.commit()
     return item
 
 def pop_version(pid: str) -> Optional[Dict]:
@@ -211,7 +284,7 @@ def pop_version(pid: str) -> Optional[Dict]:
         return None
     # pop latest and return it
     latest = versions[pid].pop()
-    transaction.commit()
+    txn_manager.commit()
     return latest
 
 def get_history_list(pid: str) -> List[Dict]:
@@ -239,25 +312,94 @@ def whoami():
 
 AUTO_REPLICATE_AFTER_WRITE = False  
 
-def background_replicate(payload):
-    """Send payload (list of dicts) to all replicas (not including primary)."""
+# Merkle buckets sent per /sync-range request (and committed together).
+SYNC_RANGE_BATCH = 1024
+
+def get_range_payload(collection: str, bucket: int) -> Dict:
+    """Return the records of `collection` in Merkle leaf `bucket`."""
+    store = root.get(collection, {})
+    # read-only: an index entry without a record is drift, which
+    # merkle.ensure_indexes() repairs at startup
+    records = [merkle.plain_record(pid, store[pid])
+               for pid in merkle.range_keys(root, collection, bucket) if pid in store]
+    return {"collection": collection, "bucket": bucket, "records": records}
+
+def anti_entropy_steps():
+    """Compare Merkle digests with one replica and resend only the buckets that differ.
+
+    Written as a generator so it does no network I/O itself: it yields
+    (method, path, kwargs) for each request to the replica and expects the
+    decoded JSON reply to be sent back. Returns (repaired, in_sync) where
+    `repaired` maps collection -> list of resent buckets.
+    """
+    repaired = {}
+    for collection in merkle.COLLECTIONS:
+        walk = merkle.diverging_buckets(merkle.get_index(root, collection))
+        try:
+            level, indexes = next(walk)
+            while True:
+                body = {"level": level, "index": indexes}
+                reply = yield "POST", f"/merkle/{collection}", {"json": body}
+                level, indexes = walk.send(reply["hashes"])
+        except StopIteration as done:
+            buckets = done.value
+        # many buckets per request, so the replica commits once per batch
+        for start in range(0, len(buckets), SYNC_RANGE_BATCH):
+            ranges = [get_range_payload(collection, b) for b in buckets[start:start + SYNC_RANGE_BATCH]]
+            yield "POST", "/sync-range", {"json": {"collection": collection, "ranges": ranges}}
+        repaired[collection] = buckets
+
+    # verify: the replica is only "synced" once its root digests match ours
+    reply = yield "GET", "/merkle", {}
+    remote_roots = reply.get("roots", {})
+    in_sync = all(remote_roots.get(c) == merkle.root_digest(root, c) for c in merkle.COLLECTIONS)
+    return repaired, in_sync
+
+def advance_steps(steps, reply=None):
+    """Advance anti_entropy_steps() under storage_lock; return (done, value)."""
+    with storage_lock:
+        try:
+            return False, steps.send(reply)
+        except StopIteration as done:
+            return True, done.value
+        except Exception:
+            txn_manager.abort()
+            raise
+
+def replicate_to(node: str, url: str) -> Optional[Dict]:
+    """Run anti-entropy against one replica and record its replication status."""
+    update_replication_status_for(node, "pending")
+    steps = anti_entropy_steps()
+    try:
+        done, value = advance_steps(steps)
+        while not done:
+            method, path, kwargs = value
+            r = requests.request(method, f"{url}{path}", timeout=5, **kwargs)
+            r.raise_for_status()
+            done, value = advance_steps(steps, r.json())
+    except Exception as e:
+        update_replication_status_for(node, "error")
+        app.logger.warning(f"Replicate -> error to {node}: {e}")
+        return None
+    repaired, in_sync = value
+    update_replication_status_for(node, "synced" if in_sync else "error")
+    return repaired
+
+def background_replicate():
+    """Run anti-entropy against all replicas (not including primary)."""
     state = read_cluster_state()
     primary = state.get("primary")
     for node, url in nodes_map.items():
         if node == primary:
             continue
-        try:
-            update_replication_status_for(node, "pending")
-            resp = requests.post(f"{url}/sync-data", json=payload, timeout=5)
-            if resp.status_code == 200:
-                update_replication_status_for(node, "synced")
-            else:
-                update_replication_status_for(node, "error")
-        except Exception as e:
-            update_replication_status_for(node, "error")
-            app.logger.warning(f"Replicate -> error to {node}: {e}")
+        replicate_to(node, url)
+
+def schedule_replication():
+    """Start background_replicate after a write; asgi_server.py replaces this."""
+    threading.Thread(target=background_replicate, daemon=True).start()
 
 @app.route("/people", methods=["GET"])
+@with_storage
 def get_people():
     """Read all people, including deleted ones."""
     _ensure_history_structures()
@@ -298,6 +440,7 @@ def get_people():
 
 
 @app.route("/people", methods=["POST"])
+@with_storage
 def add_person():
     payload = request.json or {}
     name = payload.get("name")
@@ -306,20 +449,21 @@ def add_person():
     new_key = f"p{len(people) + 1}"
     new_obj = {"id": new_key, "name": name, "age": age}
     people[new_key] = new_obj
-    transaction.commit()
+    _touch_digests(new_key)
+    txn_manager.commit()
 
     _ensure_history_structures()
     root["versions"][new_key] = [new_obj.copy()]
     root["redo_stack"][new_key] = []
-    transaction.commit()
+    txn_manager.commit()
 
     if is_primary() and AUTO_REPLICATE_AFTER_WRITE:
-        payload_list = get_local_people_list()
-        threading.Thread(target=background_replicate, args=(payload_list,), daemon=True).start()
+        schedule_replication()
 
     return jsonify({"status": "ok", "id": new_key, "written_to": NODE_NAME})
 
 @app.route("/people/<pid>", methods=["PUT"])
+@with_storage
 def update_person(pid):
     if pid not in root["people"]:
         return jsonify({"error": "Not found"}), 404
@@ -335,7 +479,8 @@ def update_person(pid):
     else:
         setattr(p, "name", data_json.get("name", getattr(p, "name", "")))
         setattr(p, "age", int(data_json.get("age", getattr(p, "age", 0))))
-    transaction.commit()
+    _touch_digests(pid)
+    txn_manager.commit()
 
     # push previous snapshot to versions (we keep versions as snapshots in chronological order)
     _ensure_history_structures()
@@ -348,14 +493,15 @@ def update_person(pid):
         root["versions"][pid].append(current_state.copy())
 
     root["redo_stack"][pid] = []
-    transaction.commit()
+    txn_manager.commit()
 
     if is_primary() and AUTO_REPLICATE_AFTER_WRITE:
-        threading.Thread(target=background_replicate, args=(get_local_people_list(),), daemon=True).start()
+        schedule_replication()
 
     return jsonify({"status": "updated", "id": pid})
 
 @app.route("/people/<pid>", methods=["DELETE"])
+@with_storage
 def delete_person(pid):
     """Xóa mềm 1 bản ghi, có thể Undo lại."""
     _ensure_history_structures()
@@ -382,21 +528,19 @@ def delete_person(pid):
 
     # Xóa khỏi danh sách hiển thị chính
     del root["people"][pid]
+    _touch_digests(pid)
 
-    transaction.commit()
+    txn_manager.commit()
 
     # replication tự động
     if is_primary() and AUTO_REPLICATE_AFTER_WRITE:
-        threading.Thread(
-            target=background_replicate,
-            args=(get_local_people_list(),),
-            daemon=True
-        ).start()
+        schedule_replication()
 
     return jsonify({"status": "deleted", "id": pid})
 
 
 @app.route("/people/<pid>/history", methods=["GET"])
+@with_storage
 def get_person_history(pid):
     hist = get_history_list(pid)
 
@@ -406,6 +550,7 @@ def get_person_history(pid):
     return jsonify(out)
 
 @app.route("/people/<pid>/undo", methods=["POST"])
+@with_storage
 def undo_person(pid):
     """Hoàn tác hành động cuối cùng (Undo)."""
     _ensure_history_structures()
@@ -443,7 +588,8 @@ def undo_person(pid):
             # Bình thường → quay lại bản trước
             root["people"][pid] = prev.copy()
 
-    transaction.commit()
+    _touch_digests(pid)
+    txn_manager.commit()
 
     # Trả về kèm lịch sử để React không crash
     hist = get_history_list(pid)
@@ -457,6 +603,7 @@ def undo_person(pid):
 
 
 @app.route("/people/<pid>/redo", methods=["POST"])
+@with_storage
 def redo_person(pid):
     _ensure_history_structures()
     redo = root["redo_stack"]
@@ -475,10 +622,12 @@ def redo_person(pid):
     else:
         root["people"][pid] = item.copy()
 
-    transaction.commit()
+    _touch_digests(pid)
+    txn_manager.commit()
     return jsonify({"status": "redone", "id": pid, "history": get_history_list(pid)})
 
 @app.route("/sync-data", methods=["POST"])
+@with_storage
 def sync_data():
     data = request.json or []
     # Replace local people with payload and reset versions/redo for replaced pids
@@ -486,6 +635,97 @@ def sync_data():
     update_replication_status_for(NODE_NAME, "synced")
     return jsonify({"status": "synced", "node": NODE_NAME, "count": len(data)})
 
+@app.route("/sync-range", methods=["POST"])
+@with_storage
+def sync_range():
+    """Replace a batch of Merkle buckets of a collection with the primary's records.
+
+    Body: {"collection": ..., "ranges": [{"bucket": 12, "records": [...]}, ...]}
+    """
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        return jsonify({"error": "body must be a JSON object"}), 400
+    collection = body.get("collection")
+    if collection not in merkle.COLLECTIONS:
+        return jsonify({"error": f"Unknown collection {collection}"}), 400
+    ranges = body.get("ranges")
+    if not isinstance(ranges, list) or not all(isinstance(r, dict) for r in ranges):
+        return jsonify({"error": "ranges must be a list of objects"}), 400
+    for r in ranges:
+        error = _check_range(r)
+        if error:
+            return jsonify({"error": error}), 400
+
+    for r in ranges:
+        replace_local_range(collection, r["bucket"], r.get("records", []))
+    txn_manager.commit()
+    return jsonify({"status": "synced", "node": NODE_NAME, "collection": collection,
+                    "buckets": len(ranges), "count": sum(len(r.get("records", [])) for r in ranges)})
+
+def _check_range(r: Dict) -> Optional[str]:
+    """Return why one /sync-range entry is malformed, or None."""
+    bucket = r.get("bucket")
+    if type(bucket) is not int or not 0 <= bucket < merkle.LEAF_COUNT:
+        return "bucket must be an integer leaf index"
+    records = r.get("records", [])
+    if not isinstance(records, list):
+        return "records must be a list"
+    if not all(isinstance(p, dict) and isinstance(p.get("id"), str) for p in records):
+        return "every record must be an object with a string id"
+    try:
+        for p in records:
+            int(p.get("age", 0))
+    except (TypeError, ValueError):
+        return "age must be an integer"
+    if any(merkle.bucket_of(p["id"]) != bucket for p in records):
+        return f"records outside bucket {bucket}"
+    return None
+
+
+@app.route("/merkle", methods=["GET"])
+@with_storage
+def merkle_roots():
+    return jsonify({
+        "node": NODE_NAME,
+        "depth": merkle.TREE_DEPTH,
+        "roots": {c: merkle.root_digest(root, c) for c in merkle.COLLECTIONS}
+    })
+
+@app.route("/merkle/<collection>", methods=["GET", "POST"])
+@with_storage
+def merkle_level(collection):
+    """Hashes of one tree level; `index` selects nodes of that level.
+
+    GET takes ?level=3&index=2,3. POST takes {"level": 3, "index": [2, 3]}
+    and is what replication uses, since its index lists can be long.
+    """
+    if collection not in merkle.COLLECTIONS:
+        return jsonify({"error": "Not found"}), 404
+    args = request.args if request.method == "GET" else request.get_json(silent=True)
+    if not isinstance(args, dict) and request.method == "POST":
+        return jsonify({"error": "body must be a JSON object"}), 400
+    try:
+        level = int(args.get("level", 0))
+        if not 0 <= level <= merkle.TREE_DEPTH:
+            raise ValueError(f"level must be between 0 and {merkle.TREE_DEPTH}")
+        indexes = merkle.parse_indexes(args.get("index"), level)
+    except (TypeError, ValueError) as e:
+        return jsonify({"error": str(e)}), 400
+    hashes = merkle.node_hashes(root, collection, level, indexes)
+    return jsonify({
+        "collection": collection,
+        "level": level,
+        "index": indexes,
+        "hashes": [h.hex() for h in hashes]
+    })
+
+@app.route("/merkle/<collection>/range/<int:bucket>", methods=["GET"])
+@with_storage
+def merkle_range(collection, bucket):
+    if collection not in merkle.COLLECTIONS or bucket >= merkle.LEAF_COUNT:
+        return jsonify({"error": "Not found"}), 404
+    return jsonify(get_range_payload(collection, bucket))
+
 
 @app.route("/run-replication", methods=["POST"])
 def run_replication():
@@ -494,21 +734,11 @@ def run_replication():
     if NODE_NAME != primary:
         return jsonify({"error": "Only primary can run replication", "primary": primary}), 403
 
-    payload = get_local_people_list()
     # replicate synchronously (will update cluster_state statuses)
     for node, url in nodes_map.items():
         if node == primary:
             continue
-        try:
-            update_replication_status_for(node, "pending")
-            r = requests.post(f"{url}/sync-data", json=payload, timeout=5)
-            if r.status_code == 200:
-                update_replication_status_for(node, "synced")
-            else:
-                update_replication_status_for(node, "error")
-        except Exception as e:
-            update_replication_status_for(node, "error")
-            app.logger.warning(f"run_replication error to {node}: {e}")
+        replicate_to(node, url)
 
     state = read_cluster_state()
     return jsonify(state.get("replication_status", {}))
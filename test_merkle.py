@@ -0,0 +1,78 @@
+# test_merkle.py
+import pytest
+from BTrees.OOBTree import OOBTree
+
+import merkle
+
+
+def make_root(n):
+    root = {"people": OOBTree(), "deleted_people": OOBTree()}
+    for i in range(n):
+        pid = f"p{i}"
+        root["people"][pid] = {"id": pid, "name": f"n{i}", "age": i % 90}
+    merkle.ensure_indexes(root)
+    return root
+
+def walk(local, remote, collection="people"):
+    """Drive diverging_buckets() of `local` against the tree of `remote`."""
+    steps = merkle.diverging_buckets(merkle.get_index(local, collection))
+    try:
+        level, indexes = next(steps)
+        while True:
+            hashes = merkle.node_hashes(remote, collection, level, indexes)
+            level, indexes = steps.send([h.hex() for h in hashes])
+    except StopIteration as done:
+        return done.value
+
+
+def test_bucket_of_is_a_leaf_index():
+    assert all(0 <= merkle.bucket_of(f"p{i}") < merkle.LEAF_COUNT for i in range(1000))
+    assert merkle.bucket_of("p1") == merkle.bucket_of("p1")
+
+def test_touch_matches_rebuild():
+    root = make_root(500)
+    people = root["people"]
+    people["p3"]["age"] = 99
+    del people["p4"]
+    people["new"] = {"id": "new", "name": "x", "age": 1}
+    for pid in ("p3", "p4", "new"):
+        merkle.touch(root, "people", pid)
+
+    index = merkle.get_index(root, "people")
+    touched = (merkle.root_digest(root, "people"), dict(index.entries.items()), dict(index.nodes.items()))
+    merkle.rebuild(root, "people")
+    index = merkle.get_index(root, "people")
+    assert touched == (merkle.root_digest(root, "people"), dict(index.entries.items()), dict(index.nodes.items()))
+    assert merkle.index_matches(index, people)
+
+def test_removing_everything_leaves_an_empty_tree():
+    root = make_root(50)
+    for pid in list(root["people"].keys()):
+        del root["people"][pid]
+        merkle.touch(root, "people", pid)
+    assert len(merkle.get_index(root, "people").nodes) == 0
+    assert merkle.root_digest(root, "people") == merkle.root_digest(make_root(0), "people")
+
+def test_diverging_buckets_finds_exactly_the_changed_buckets():
+    local, remote = make_root(2000), make_root(2000)
+    assert walk(local, remote) == []
+
+    remote["people"]["p7"]["age"] = 50
+    del remote["people"]["p8"]
+    remote["people"]["extra"] = {"id": "extra", "name": "e", "age": 2}
+    for pid in ("p7", "p8", "extra"):
+        merkle.touch(remote, "people", pid)
+
+    expected = sorted({merkle.bucket_of(pid) for pid in ("p7", "p8", "extra")})
+    assert sorted(walk(local, remote)) == expected
+
+def test_parse_indexes():
+    assert merkle.parse_indexes("1,3", 2) == [1, 3]
+    assert merkle.parse_indexes([0, 2], 2) == [0, 2]
+    assert merkle.parse_indexes(None, 2) == [0, 1, 2, 3]
+    with pytest.raises(ValueError):
+        merkle.parse_indexes("4", 2)
+    with pytest.raises(ValueError):
+        merkle.parse_indexes(["1"], 2)
+    with pytest.raises(ValueError):
+        merkle.parse_indexes(None, merkle.TREE_DEPTH)